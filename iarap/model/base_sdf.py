@@ -53,12 +53,15 @@ class SDF(nn.Module):
     
     def project_level_sets(self, 
                            x_in: Float[Tensor, "*batch sample 3"],
-                           origin_dist: Optional[Float[Tensor, "*batch 1"]]
-                           ) -> Float[Tensor, "*batch 3"]:
+                           origin_dist: Float[Tensor, "*batch 1 1"]
+                           ) -> Float[Tensor, "*batch sample 3"]:
+        # One level per patch, broadcast over the patch samples
+        assert origin_dist.shape == (*x_in.shape[:-2], 1, 1), \
+            f"origin_dist must have shape (*batch, 1, 1), got {tuple(origin_dist.shape)} for samples {tuple(x_in.shape)}"
         x = x_in.requires_grad_()
         dist = self.distance(x)
         grad = self.gradient(x, dist)
-        return x_in - (dist - origin_dist.unsqueeze(1)) * F.normalize(grad, dim=-1)
+        return x_in - (dist - origin_dist) * F.normalize(grad, dim=-1)
     
     def sphere_trace(self, 
                      x_in: Float[Tensor, "*batch 3"],
@@ -6,35 +6,49 @@ import numpy as np
 
 from torch import Tensor
 from jaxtyping import Float
-from typing import Dict, Type, Tuple, Any
+from typing import Dict, Literal, Type, Tuple, Any
 from dataclasses import dataclass, field
 
 from iarap.config.base_config import InstantiateConfig
 from iarap.model.base_sdf import SDF
 from iarap.model.nn import MLP, FourierFeatsEncoding, InvertibleRtMLP, InvertibleMLP3D
 from iarap.model.nn.mlp import MLPConfig
-from iarap.utils import to_immutable_dict, euler_to_rotation
+from iarap.utils import to_immutable_dict, euler_to_rotation, quaternion_to_rotation, apply_euler_rt, apply_quaternion_rt, batch_matvec
 
     
-def fixed_point_Rt_invert(g, y, iters=15, verbose=False):
-    with torch.no_grad():
-        x = y
-        dim = x.size(-1)
-        for i in range(iters):
-            block_out = g(x)
-            rot, transl = block_out[..., :3], block_out[..., 3:]
-            rot = euler_to_rotation(rot)
-            x = (rot.transpose(-1, -2) @ (y - transl)[..., None]).squeeze(-1)
-            if verbose:
-                block_out = g(x)
-                rot, transl = block_out[..., :3], block_out[..., 3:]
-                rot = euler_to_rotation(rot)
-                test = (rot @ x[..., None]).squeeze(-1) + transl
-                err = (y - test).view(-1, dim).norm(dim=-1).mean()
-                err = err.detach().cpu().item()
-                print("iter:%d err:%s" % (i, err))
+@torch.jit.script
+def _apply_rot_params(block_out: Tensor, x: Tensor, transpose: bool, quaternion: bool) -> Tensor:
+    if quaternion:
+        return apply_quaternion_rt(block_out[..., :4], block_out[..., 4:], x, transpose)
+    return apply_euler_rt(block_out[..., :3], block_out[..., 3:], x, transpose)
+
+
+def _fp_invert_fast(g, apply_rt, y, iters):
+    x = y
+    for _ in range(iters):
+        # Fixed-point update x <- R(x)^T (y - t(x))
+        x = apply_rt(g(x), y, True)
     return x
 
+def _fp_invert_debug(g, apply_rt, y, iters):
+    # The network output at each iterate gives both the error of that iterate and the next update
+    x = y
+    dim = x.size(-1)
+    block_out = g(x)
+    for i in range(iters):
+        x = apply_rt(block_out, y, True)
+        block_out = g(x)
+        test = apply_rt(block_out, x, False)
+        err = (y - test).view(-1, dim).norm(dim=-1).mean()
+        err = err.detach().cpu().item()
+        print("iter:%d err:%s" % (i, err))
+    return x
+
+def fixed_point_Rt_invert(g, apply_rt, y, iters=15, verbose=False):
+    invert = _fp_invert_debug if verbose else _fp_invert_fast
+    with torch.no_grad():
+        return invert(g, apply_rt, y, iters)
+
 
 
 @dataclass
@@ -53,6 +67,7 @@ class NeuralRTFConfig(InstantiateConfig):
         encoding_with_input=True,
         geometric_init=True
     )
+    rotation: Literal['euler', 'quaternion'] = 'euler'  # 'quaternion' requires network.out_dim=7
 
 
 class NeuralRTF(SDF):
@@ -61,6 +76,15 @@ class NeuralRTF(SDF):
         super(NeuralRTF, self).__init__(config.network.in_dim)
         self.config = config
         self.network = self.config.network.setup()
+        self.quaternion = self.config.rotation == 'quaternion'
+        self.rot_dim = 4 if self.quaternion else 3
+        if isinstance(self.network, MLP):
+            assert self.network.out_dim == self.rot_dim + 3, \
+                f"{self.config.rotation} rotations require a network with {self.rot_dim + 3} outputs"
+            if self.quaternion and self.config.network.geometric_init:
+                # The zero-initialized head should predict the identity quaternion (1, 0, 0, 0)
+                with torch.no_grad():
+                    self.network.layers[-1].bias[0] = 1.0
         self.sdf_callable = lambda x: x.norm(dim=-1, keepdim=True) - 0.5
 
     def set_sdf_callable(self, dist_fn):
@@ -72,15 +96,19 @@ class NeuralRTF(SDF):
 
     def forward(self, 
                 x_in: Float[Tensor, "*batch in_dim"],
-                return_euler: bool = False
+                return_rot_params: bool = False
                 ) -> Dict[str, Float[Tensor, "*batch f"]]:
         outputs = {}
         rt = self.network(x_in)
         if isinstance(rt, torch.Tensor):
-            euler, transl = rt[..., :3], rt[..., 3:]
-            rot = euler_to_rotation(euler)
-            if return_euler:
-                outputs['euler'] = euler
+            rot_params, transl = rt[..., :self.rot_dim], rt[..., self.rot_dim:]
+            if self.quaternion:
+                rot = quaternion_to_rotation(rot_params)
+            else:
+                rot = euler_to_rotation(rot_params)
+            if return_rot_params:
+                # Raw rotation parameters, under the key of the configured representation
+                outputs['quaternion' if self.quaternion else 'euler'] = rot_params
         else:
             _, rot, transl = rt
         outputs['rot'] = rot
@@ -90,8 +118,7 @@ class NeuralRTF(SDF):
     def deform(self, 
                x_in: Float[Tensor, "*batch in_dim"],
                ) -> Float[Tensor, "*batch in_dim"]:
-        outputs = self(x_in)
-        return (outputs['rot'] @ x_in[..., None]).squeeze(-1) + outputs['transl']
+        return self._apply_rt(self.network(x_in), x_in)
         # return rotated
         # return self.network.inverse(x_in)
         # return fixed_point_invert(self.model, x_in)
@@ -101,4 +128,17 @@ class NeuralRTF(SDF):
                 ) -> Float[Tensor, "*batch in_dim"]:
         if hasattr(self.network, 'inverse'):
             return self.network.inverse(x_in)
-        return fixed_point_Rt_invert(self.network, x_in)
\ No newline at end of file
+        return fixed_point_Rt_invert(self.network, self._apply_rt, x_in)
+    
+    def _apply_rt(self, 
+                  rt,
+                  x_in: Float[Tensor, "*batch in_dim"],
+                  invert: bool = False
+                  ) -> Float[Tensor, "*batch in_dim"]:
+        # R x + t, or R^T (x - t) if invert, straight from the raw network output
+        if isinstance(rt, torch.Tensor):
+            return _apply_rot_params(rt, x_in, invert, self.quaternion)
+        _, rot, transl = rt
+        if invert:
+            return batch_matvec(rot, x_in - transl, transpose=True)
+        return batch_matvec(rot, x_in) + transl
\ No newline at end of file
@@ -10,7 +10,7 @@ from typing import Any, Dict, Type, Tuple
 from iarap.config.base_config import InstantiateConfig
 from iarap.model.nn.encoding import FourierFeatsEncoding, LipBoundedPosEnc
 from iarap.model.nn.mlp import MLP, MLPConfig
-from iarap.utils.linalg import align_vectors, euler_to_rotation
+from iarap.utils.linalg import align_vectors, batch_matvec, euler_to_rotation
 from iarap.utils.misc import to_immutable_dict
 
 
@@ -159,7 +159,7 @@ class InvertibleMLP3D(nn.Module):
             if focus == [1]:
                 rot_2d = rot_2d.transpose(-1, -2)
             trans_2d = focus_rt[..., 1:]
-            x_other = (rot_2d @ (x_other - trans_2d)[..., None]).squeeze(-1)
+            x_other = batch_matvec(rot_2d, x_other - trans_2d)
             x = combine_coords(x_other, x_focus, other, focus)
 
             # aggregate rototranslation on "other" coordinates
@@ -174,7 +174,7 @@ class InvertibleMLP3D(nn.Module):
             
         R = T[..., 0:3, 0:3]
         t = T[..., 0:3, 3]
-        out_x = (R @ input_pts[..., None]).squeeze() + t
+        out_x = batch_matvec(R, input_pts) + t
         return out_x, R, t
 
     def inverse(self, input_pts):
@@ -192,7 +192,7 @@ class InvertibleMLP3D(nn.Module):
             if other == [1]:
                 rot_2d = rot_2d.transpose(-1, -2)
             trans_2d = focus_rt[..., 1:]
-            x_focus = (rot_2d @ x_focus[..., None]).squeeze(-1) + trans_2d
+            x_focus = batch_matvec(rot_2d, x_focus) + trans_2d
 
             # part a
             x_diff = self.blocks_xy[i_b](self.encoding_xy(x_focus))
@@ -212,7 +212,7 @@ def fixed_point_invert(g, y, iters=15, verbose=False, op='rotation'):
             block_out = g(x)
             if op == 'rotation':
                 rot = euler_to_rotation(block_out)
-                x = (rot.transpose(-1, -2) @ y[..., None]).squeeze(-1)
+                x = batch_matvec(rot, y, transpose=True)
             elif op == 'translation':
                 x = y - block_out
             else:
@@ -220,7 +220,7 @@ def fixed_point_invert(g, y, iters=15, verbose=False, op='rotation'):
             if verbose:
                 if op == 'rotation':
                     rot = euler_to_rotation(g(x))
-                    test = (rot @ x[..., None]).squeeze(-1)
+                    test = batch_matvec(rot, x)
                 elif op == 'translation':
                     test = x + g(x)
                 err = (y - test).view(-1, dim).norm(dim=-1).mean()
@@ -297,7 +297,7 @@ class InvertibleRotBlock(InvertibleBlock):
     def forward(self, x):
         euler = self.forward_g(x)
         rot = euler_to_rotation(euler)
-        return (rot @ x[..., None]).squeeze(-1), euler
+        return batch_matvec(rot, x), euler
 
     
 class InvertibleResidualBlock(InvertibleBlock):
@@ -344,7 +344,7 @@ class InvertibleRtMLP(nn.Module):
             out, _ = block(out)
 
         rot = align_vectors(out, x)
-        transl = out - (rot @ x[..., None]).squeeze(-1).detach()
+        transl = out - batch_matvec(rot, x).detach()
         return out, rot, transl
 
     def inverse(self, y, verbose=False, iters=15):
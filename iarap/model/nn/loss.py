@@ -11,6 +11,7 @@ from typing import Dict, Literal, Type
 from dataclasses import dataclass, field
 
 from iarap.config.base_config import InstantiateConfig
+from iarap.utils.linalg import batch_matvec
 
 
 @dataclass
@@ -120,7 +121,7 @@ class DeformationLoss(nn.Module):
                 static_gt: Float[Tensor, "h_2 3"]
                 ) -> Float[Tensor, "1"]:
         patch_arap_loss = self.arap_loss(patch_verts, faces, rotations, translations)
-        transformed_verts = (rotations @ patch_verts[..., None]).squeeze(-1) + translations
+        transformed_verts = batch_matvec(rotations, patch_verts) + translations
         moving_pos = transformed_verts[moving_idx[:, 0], moving_idx[:, 1], :]
         static_pos = transformed_verts[static_idx[:, 0], static_idx[:, 1], :]
         moving_handle_loss = self.handle_loss(moving_pos, moving_gt) if moving_gt.shape[0] > 0 else 0.0
@@ -179,10 +180,10 @@ class PatchARAPLoss(nn.Module):
         idx = torch.cat([faces[:, :2], faces[:, 1:], faces[:, ::2]], dim=0).T
         w_per_edge = w[:, idx[0, :], idx[1, :]]
 
-        transformed_verts = (rotations @ patch_verts[..., None]).squeeze(-1) + translations
+        transformed_verts = batch_matvec(rotations, patch_verts) + translations
         rot_verts_edges = transformed_verts[:, idx[0, :], :] - transformed_verts[:, idx[1, :], :]
 
         edges_source = patch_verts[:, idx[0, :], :] - patch_verts[:, idx[1, :], :]
-        rot_edges = (rotations[:, idx[0, :], ...] @ edges_source[..., None]).squeeze(-1)  # + translations[:, idx[0, :], :]
+        rot_edges = batch_matvec(rotations[:, idx[0, :], ...], edges_source)  # + translations[:, idx[0, :], :]
 
         return (w_per_edge * (rot_edges - rot_verts_edges).pow(2).sum(dim=-1)).sum(dim=-1).mean(dim=0)
\ No newline at end of file
@@ -72,15 +72,14 @@ class MLP(nn.Module):
         self.layers = nn.ModuleList(layers)
 
     def geometric_init(self):
+        last = len(self.layers) - 1
         for j, lin in enumerate(self.layers):
-            if j == len(self.layers) - 1:
-                if self.out_dim > 1:
-                    torch.nn.init.zeros_(lin.weight)
-                    torch.nn.init.zeros_(lin.bias)
-                    return  # Don't do weight normalization
-                else:
-                    torch.nn.init.normal_(lin.weight, mean=np.sqrt(np.pi) / np.sqrt(lin.in_features), std=0.0001)
-                    torch.nn.init.constant_(lin.bias, -0.5)
+            if j == last and self.out_dim > 1:
+                torch.nn.init.zeros_(lin.weight)
+                torch.nn.init.zeros_(lin.bias)
+            elif j == last:
+                torch.nn.init.normal_(lin.weight, mean=np.sqrt(np.pi) / np.sqrt(lin.in_features), std=0.0001)
+                torch.nn.init.constant_(lin.bias, -0.5)
             elif self.encoding is not None and j == 0:
                 torch.nn.init.constant_(lin.bias, 0.0)
                 torch.nn.init.constant_(lin.weight, 0.0)
@@ -92,7 +91,12 @@ class MLP(nn.Module):
             else:
                 torch.nn.init.constant_(lin.bias, 0.0)
                 torch.nn.init.normal_(lin.weight, 0.0, np.sqrt(2) / np.sqrt(lin.out_features))
-            self.layers[j] = nn.utils.parametrizations.weight_norm(lin)
+        # A zero-initialized multi-dimensional head is left out of weight normalization
+        num_normalized = last if self.out_dim > 1 else last + 1
+        self.layers = nn.ModuleList([
+            nn.utils.parametrizations.weight_norm(lin) if j < num_normalized else lin 
+            for j, lin in enumerate(self.layers)
+        ])
 
     def forward(self, in_tensor: Float[Tensor, "*bs in_dim"]) -> Float[Tensor, "*bs out_dim"]:
         """Process input with a multilayer perceptron.
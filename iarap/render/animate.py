@@ -16,8 +16,9 @@ from tqdm import tqdm
 from iarap.config.base_config import InstantiateConfig
 from iarap.model.neural_rtf import NeuralRTFConfig
 from iarap.model.neural_sdf import NeuralSDFConfig
-from iarap.utils import gradient, euler_to_rotation
-from iarap.utils.misc import detach_model
+from iarap.utils import batch_matvec, pointwise_value_and_grad, euler_to_rotation, quaternion_to_rotation
+from iarap.utils.meshing import grid_slices
+from iarap.utils.misc import detach_model, fuse_parametrizations
 
 
 
@@ -32,27 +33,24 @@ class Animator:
     def setup_model(self):
         self.shape_model = self.config.shape_model.setup().to(self.config.device)
         self.shape_model.load_state_dict(torch.load(self.config.load_shape))
+        fuse_parametrizations(self.shape_model)
         detach_model(self.shape_model)
         self.deformation_model = self.config.deformation_model.setup().to(self.config.device)
         self.deformation_model.load_state_dict(torch.load(self.config.load_deformation))
+        fuse_parametrizations(self.deformation_model)
         detach_model(self.deformation_model)
-        vol = self.make_volume()
-        self.cached_sdf = self.evaluate_model(vol).numpy()
-
-    def make_volume(self):
-        steps = torch.linspace(self.config.min_coord, 
-                               self.config.max_coord, 
-                               self.config.resolution,
-                               device=self.config.device)
-        xx, yy, zz = torch.meshgrid(steps, steps, steps, indexing="ij")
-        return torch.vstack([xx.ravel(), yy.ravel(), zz.ravel()]).T.float()
+        self.cached_sdf = self.evaluate_model().numpy()
 
     @torch.no_grad()
-    def evaluate_model(self, pts_volume):    
-        f_eval = []
-        for sample in tqdm(torch.split(pts_volume, self.config.chunk, dim=0)):
-            f_eval.append(self.sdf_functional(sample.contiguous()).cpu())
-        f_volume = torch.cat(f_eval, dim=0).reshape(*([self.config.resolution] * 3))
+    def evaluate_model(self):    
+        res = self.config.resolution
+        f_volume = torch.empty(res, res, res)
+        slices = grid_slices(res, (self.config.min_coord, self.config.max_coord), self.config.device)
+        for i, pts_slice in enumerate(tqdm(slices, total=res)):
+            samples = torch.split(pts_slice, self.config.chunk, dim=0)
+            f_outs = torch.split(f_volume[i].view(-1, 1), self.config.chunk, dim=0)
+            for sample, f_out in zip(samples, f_outs):
+                f_out.copy_(self.sdf_functional(sample))
         return f_volume
     
     def extract_mesh(self, level=0.0):
@@ -69,10 +67,19 @@ class Animator:
         verts = torch.from_numpy(verts).to(self.config.device, torch.float)
         out_verts = []
         for sample in torch.split(verts, self.config.chunk, dim=0):
-            outputs = self.deformation_model(sample, return_euler=True)  # transform(sample)
-            rot = euler_to_rotation(outputs['euler'] * alpha)
+            outputs = self.deformation_model(sample, return_rot_params=True)  # transform(sample)
+            if 'quaternion' in outputs:
+                # Normalized lerp from the identity, on the hemisphere of the predicted rotation.
+                # The network output is not unit norm: normalize first so the blend is linear in alpha like the translation
+                quat = F.normalize(outputs['quaternion'], dim=-1)
+                quat = quat * torch.where(quat[..., :1] < 0, -1.0, 1.0)
+                identity = torch.zeros_like(quat)
+                identity[..., 0] = 1.0
+                rot = quaternion_to_rotation(torch.lerp(identity, quat, alpha))
+            else:
+                rot = euler_to_rotation(outputs['euler'] * alpha)
             transl = outputs['transl'] * alpha
-            transformed = (rot @ sample[..., None]).squeeze(-1) + transl
+            transformed = batch_matvec(rot, sample) + transl
             out_verts.append(transformed.cpu().detach().numpy())
         verts = np.concatenate(out_verts, axis=0)
         return verts
@@ -82,12 +89,13 @@ class Animator:
         return model_out['dist']
     
     def project_nearest(self, query, n_its=5, level=0.0):
-        query = torch.from_numpy(query).float().to(self.config.device).view(-1, 3).requires_grad_()
+        # Gradients come from torch.func transforms, so the query never carries an autograd graph
+        # Cloned: from_numpy aliases float32 arrays on CPU, and the query is updated in place
+        query = torch.from_numpy(query).float().to(self.config.device).view(-1, 3).clone()
         for i in range(n_its):
-            dist = self.sdf_functional(query) - level
-            grad = F.normalize(gradient(dist, query), dim=-1)
-            query = (query - dist * grad).detach().requires_grad_()
-        return query.detach()
+            dist, grad = pointwise_value_and_grad(self.sdf_functional, query)
+            query.sub_((dist - level) * F.normalize(grad, dim=-1))
+        return query
 
     def run(self):
 
@@ -10,7 +10,9 @@ import polyscope as ps
 import polyscope.imgui as psim
 import torch.nn.functional as F
 
+from concurrent.futures import ThreadPoolExecutor
 from typing import Tuple, Type, Literal
+from collections import OrderedDict
 from dataclasses import dataclass, field
 from pathlib import Path
 from tqdm import tqdm
@@ -18,11 +20,46 @@ from tqdm import tqdm
 from iarap.config.base_config import InstantiateConfig
 from iarap.model.neural_rtf import NeuralRTFConfig
 from iarap.model.neural_sdf import NeuralSDFConfig
-from iarap.utils import gradient, euler_to_rotation
-from iarap.utils.misc import detach_model
+from iarap.utils import euler_to_rotation, pointwise_value_and_grad
+from iarap.utils.meshing import grid_slices
+from iarap.utils.misc import detach_model, fuse_parametrizations
 
 
 
+PRECISIONS = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+class PointBuffer:
+
+    """
+    Growable (n, 3) array of picked points. Points are appended in place,
+    so the selection never needs to be restacked from a list.
+    """
+
+    def __init__(self, capacity: int = 256):
+        self.data = np.empty((capacity, 3))
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def points(self) -> np.ndarray:
+        return self.data[:self.size]
+
+    def append(self, pts: np.ndarray):
+        pts = pts.reshape(-1, 3)
+        if self.size + pts.shape[0] > self.data.shape[0]:
+            data = np.empty((max(2 * self.data.shape[0], self.size + pts.shape[0]), 3))
+            data[:self.size] = self.points
+            self.data = data
+        self.data[self.size:self.size + pts.shape[0]] = pts
+        self.size += pts.shape[0]
+
+    def clear(self):
+        self.size = 0
+
+
 class SDFRenderer:
 
     def __init__(self, config: SDFRendererConfig):
@@ -30,18 +67,28 @@ class SDFRenderer:
         self.setup_model()
 
     def setup_model(self):
+        # CPU autocast only supports bfloat16, fp16 would silently fall back to fp32
+        assert self.config.device == 'cuda' or self.config.precision != 'fp16', \
+            "precision='fp16' requires device='cuda', use 'bf16' on CPU"
+        self.mesh_cache = OrderedDict()
         if self.config.load_deformation is not None:
             self.deformation_model = self.config.deformation_model.setup().to(self.config.device)
             self.deformation_model.load_state_dict(torch.load(self.config.load_deformation))
+            fuse_parametrizations(self.deformation_model)
             detach_model(self.deformation_model)
         else:
             self.deformation_model = None
         if self.config.shape_type == 'sdf':
             self.shape_model = self.config.shape_model.setup().to(self.config.device)
             self.shape_model.load_state_dict(torch.load(self.config.load_shape))
+            fuse_parametrizations(self.shape_model)
             detach_model(self.shape_model)
-            vol = self.make_volume()
-            self.cached_sdf = self.evaluate_model(vol).numpy()
+            # Models are frozen and evaluate_model feeds fixed-size chunks, so the graph is traced only once
+            self.volume_functional = self.sdf_functional
+            if self.config.compile:
+                self.volume_functional = torch.compile(self.sdf_functional, dynamic=False)
+            self.cached_sdf = self.evaluate_model().numpy()
+            self.sdf_range = (float(self.cached_sdf.min()), float(self.cached_sdf.max()))
         elif self.config.shape_type == 'mesh':
             assert self.config.deform_mode == 'explicit', "Implicit deformation does not make sense with mesh input."
             self.shape = trimesh.load(self.config.load_shape)
@@ -59,56 +106,104 @@ class SDFRenderer:
             deform = self.deformation_model.deform(pts) - pts
             self.vis_deform = np.concatenate([pts.cpu().detach().numpy(), deform.cpu().detach().numpy()], axis=-1)
 
-    def make_volume(self):
-        steps = torch.linspace(self.config.min_coord, 
-                               self.config.max_coord, 
-                               self.config.resolution,
-                               device=self.config.device)
-        xx, yy, zz = torch.meshgrid(steps, steps, steps, indexing="ij")
-        return torch.vstack([xx.ravel(), yy.ravel(), zz.ravel()]).T.float()
-
     @torch.no_grad()
-    def evaluate_model(self, pts_volume):    
-        f_eval = []
-        for sample in tqdm(torch.split(pts_volume, self.config.chunk, dim=0)):
-            f_eval.append(self.sdf_functional(sample.contiguous()).cpu())
-        f_volume = torch.cat(f_eval, dim=0).reshape(*([self.config.resolution] * 3))
-        return f_volume
+    def evaluate_model(self):    
+        res = self.config.resolution
+        host_copy = self.config.device == 'cuda'
+        # Chunks are written in place into the preallocated volume, pinned so D2H copies can be async
+        f_volume = torch.empty(res ** 3, 1, pin_memory=host_copy)
+        if host_copy:
+            copy_stream = torch.cuda.Stream()
+        # Grid points are generated one slice at a time, the full coordinate volume is never materialized
+        slices = grid_slices(res, (self.config.min_coord, self.config.max_coord), self.config.device)
+        chunk = min(self.config.chunk, res ** 2)
+        start = 0
+        for pts_slice in tqdm(slices, total=res):
+            for sample in torch.split(pts_slice, chunk, dim=0):
+                n = sample.shape[0]
+                if self.config.compile and n < chunk:
+                    # Pad the trailing chunk to the traced shape
+                    sample = F.pad(sample, (0, 0, 0, chunk - n))
+                f_eval = self.volume_functional(sample)[:n]
+                f_out = f_volume[start:start + n]
+                if host_copy:
+                    # Copy this chunk on a side stream while the next one is evaluated
+                    copy_stream.wait_stream(torch.cuda.current_stream())
+                    with torch.cuda.stream(copy_stream):
+                        f_out.copy_(f_eval, non_blocking=True)
+                    f_eval.record_stream(copy_stream)
+                else:
+                    f_out.copy_(f_eval)
+                start += n
+        if host_copy:
+            copy_stream.synchronize()
+        return f_volume.view(res, res, res)
+    
+    def autocast(self):
+        # Models are frozen, so reduced precision only affects inference
+        return torch.autocast(device_type=self.config.device, 
+                              dtype=PRECISIONS[self.config.precision], 
+                              enabled=self.config.precision != 'fp32')
     
     def sdf_functional(self, query):
         sample = query
-        if self.deformation_model is not None and self.config.deform_mode == 'implicit':
-            sample = self.deformation_model.inverse(sample)  
-        model_out = self.shape_model(sample)
-        return model_out['dist']
+        with self.autocast():
+            if self.deformation_model is not None and self.config.deform_mode == 'implicit':
+                sample = self.deformation_model.inverse(sample)  
+            model_out = self.shape_model(sample)
+        return model_out['dist'].float()
     
     def extract_mesh(self, level=0.0):
-        try:
-            verts, faces = mcubes.marching_cubes(self.cached_sdf, level)
-            verts /= self.config.resolution // 2
-            verts -= 1.0
-        except:
-            verts = np.empty([0, 3], dtype=np.float32)
-            faces = np.empty([0, 3], dtype=np.int32)
+        # Level sets are revisited often when browsing with the slider, reuse previous extractions
+        if level in self.mesh_cache:
+            self.mesh_cache.move_to_end(level)
+            return self.mesh_cache[level]
+        if not self.sdf_range[0] < level < self.sdf_range[1]:
+            # The grid does not cross this level, there is no surface to extract
+            return self.empty_mesh()
+        verts, faces = mcubes.marching_cubes(self.cached_sdf, level)
+        if faces.shape[0] == 0:
+            return self.empty_mesh()
+        verts /= self.config.resolution // 2
+        verts -= 1.0
         if self.deformation_model is not None and self.config.deform_mode == 'explicit':
             verts = self.deform_points(verts)
+        if self.config.mesh_cache_size > 0:
+            self.mesh_cache[level] = (verts, faces)
+            if len(self.mesh_cache) > self.config.mesh_cache_size:
+                self.mesh_cache.popitem(last=False)
         return verts, faces
     
+    def empty_mesh(self):
+        # Not cached: an empty result is cheap to recompute and must never shadow a real extraction
+        return np.empty([0, 3], dtype=np.float32), np.empty([0, 3], dtype=np.int32)
+    
     def deform_points(self, verts):
         verts = torch.from_numpy(verts).to(self.config.device, torch.float)
         out_verts = []
         for sample in torch.split(verts, self.config.chunk, dim=0):
-            transformed = self.deformation_model.deform(sample)  # transform(sample)
-            out_verts.append(transformed.cpu().detach().numpy())
+            with self.autocast():
+                transformed = self.deformation_model.deform(sample)  # transform(sample)
+            out_verts.append(transformed.float().cpu().detach().numpy())
         return np.concatenate(out_verts, axis=0)
 
     def project_nearest(self, query, n_its=5, level=0.0):
-        query = torch.from_numpy(query).float().to(self.config.device).view(-1, 3).requires_grad_()
+        # Gradients come from torch.func transforms, so the query never carries an autograd graph
+        # Cloned: from_numpy aliases float32 arrays on CPU, and the query is updated in place
+        query = torch.from_numpy(query).float().to(self.config.device).view(-1, 3).clone()
         for i in range(n_its):
-            dist = self.sdf_functional(query) - level
-            grad = F.normalize(gradient(dist, query), dim=-1)
-            query = (query - dist * grad).detach().requires_grad_()
-        return query.detach()
+            dist, grad = pointwise_value_and_grad(self.sdf_functional, query)
+            if i == 0 and not grad.any():
+                # fixed_point_Rt_invert runs under no_grad, torch.func then reports a zero gradient instead of failing
+                raise RuntimeError("SDF gradient vanished: implicit projection requires a deformation model with an analytic inverse")
+            query.sub_((dist - level) * F.normalize(grad, dim=-1))
+        return query
+
+    def project_pick(self, world_pos, level=0.0):
+        # Runs on the picking worker thread, on its own stream so it does not serialize with rendering work
+        with torch.cuda.stream(self.pick_stream):
+            projected = self.project_nearest(world_pos, n_its=10, level=level)
+            return projected.squeeze().cpu().numpy()
 
     def run(self):
 
@@ -116,7 +211,10 @@ class SDFRenderer:
         ps.set_window_size(*self.config.window_size)
         ps.set_window_resizable(True)
 
-        live_picks, frozen_picks = [], []
+        live_picks, frozen_picks = PointBuffer(), PointBuffer()
+        pending_picks = []
+        pick_executor = ThreadPoolExecutor(max_workers=1)
+        self.pick_stream = torch.cuda.Stream() if self.config.device == 'cuda' else None
         output_file = "path/to/point/selection/file.txt"
         input_select = "path/to/point/selection/file.txt"
         points_to_export = 'live'
@@ -133,10 +231,11 @@ class SDFRenderer:
 
         def custom_callback():
             io = psim.GetIO()
-            nonlocal live_picks, frozen_picks, output_file, input_select, points_to_export
+            nonlocal pending_picks, output_file, input_select, points_to_export
             nonlocal verts, faces
             nonlocal viewed_level_set, last_level_set
             nonlocal tx, ty, tz, rx, ry, rz, duplicate, clear_only_frozen
+            picks_changed = False
 
             if io.MouseClicked[0] and io.KeyCtrl:
                 screen_coords = io.MousePos
@@ -144,12 +243,23 @@ class SDFRenderer:
                 # print(world_pos)
                 if np.abs(world_pos).max() <= 1.0 and not np.isinf(world_pos).any():
                     if self.config.shape_type == 'sdf':
-                        world_pos = self.project_nearest(world_pos, n_its=10, level=viewed_level_set
-                                                        ).squeeze().cpu().numpy()
-                    live_picks.append(world_pos)
-                    ps.register_point_cloud("Live Picks", np.stack(live_picks, axis=0), enabled=True)
+                        # Project in background, the pick shows up once the projection is done
+                        pending_picks.append(pick_executor.submit(self.project_pick, world_pos, viewed_level_set))
+                    else:
+                        live_picks.append(world_pos)
+                        picks_changed = True
                     # self.set_picked(np.expand_dims(world_pos, axis=0))
 
+            # Collect completed projections, the point cloud is registered at most once per frame
+            done = [pick.done() for pick in pending_picks]
+            for pick, is_done in zip(pending_picks, done):
+                if is_done:
+                    live_picks.append(pick.result())
+                    picks_changed = True
+            pending_picks = [pick for pick, is_done in zip(pending_picks, done) if not is_done]
+            if picks_changed:
+                ps.register_point_cloud("Live Picks", live_picks.points, enabled=True)
+
             _, viewed_level_set = psim.SliderFloat("Level set", viewed_level_set, v_min=-1.0, v_max=1.0)
 
             if psim.Button("Zero"):
@@ -162,10 +272,9 @@ class SDFRenderer:
                 verts, faces = self.extract_mesh(level=viewed_level_set)
                 ps.register_surface_mesh("NeuralSDF", verts, faces, enabled=True)
 
-                if len(live_picks) > 0:
-                    live_picks = []
-                if len(frozen_picks) > 0:
-                    frozen_picks = []
+                pending_picks = []
+                live_picks.clear()
+                frozen_picks.clear()
                 if ps.has_point_cloud("Live Picks"):
                     ps.remove_point_cloud("Live Picks")
                 if ps.has_point_cloud("Frozen Picks"):
@@ -189,7 +298,7 @@ class SDFRenderer:
                     print(f"Saving {points_to_export} points at {output_file}")
                     pathlib.Path(output_file).parent.mkdir(parents=True, exist_ok=True)
                     try:
-                        np.savetxt(output_file, np.stack(points, axis=0))
+                        np.savetxt(output_file, points.points)
                     except:
                         print("Invalid output file location.")
                 else:
@@ -203,8 +312,8 @@ class SDFRenderer:
                     loaded = np.loadtxt(input_select)
                     if len(loaded.shape) < 2:
                         loaded = loaded.reshape(1, 3)
-                    live_picks += [x.squeeze() for x in np.split(loaded, loaded.shape[0], axis=0)]
-                    ps.register_point_cloud("Live Picks", np.stack(live_picks, axis=0), enabled=True)
+                    live_picks.append(loaded)
+                    ps.register_point_cloud("Live Picks", live_picks.points, enabled=True)
                 except:
                     print("Invalid file.")
 
@@ -239,16 +348,14 @@ class SDFRenderer:
 
             if psim.Button("Freeze transforms") and ps.has_point_cloud("Live Picks"):
                 transform = ps.get_point_cloud("Live Picks").get_transform()
-                points_to_transform = np.concatenate(
-                    [np.stack(live_picks, axis=0), np.ones((len(live_picks), 1))], axis=-1)
-                transformed = np.dot(points_to_transform, transform[:3, :].T)
-                frozen_picks += [x.squeeze() for x in np.split(transformed, transformed.shape[0], axis=0)]
-                ps.register_point_cloud("Frozen Picks", np.stack(frozen_picks, axis=0), enabled=True)
+                transformed = np.einsum('ij,nj->ni', transform[:3, :3], live_picks.points) + transform[:3, 3]
+                frozen_picks.append(transformed)
+                ps.register_point_cloud("Frozen Picks", frozen_picks.points, enabled=True)
                 
                 ps.get_point_cloud("Live Picks").set_transform(np.eye(4))
                 tx, ty, tz, rx, ry, rz = 0.0, 0.0, 0.0, 0.0, 0.0, 0.0
                 if not duplicate:
-                    live_picks = []
+                    live_picks.clear()
                     ps.remove_point_cloud("Live Picks")
             
             _, clear_only_frozen = psim.Checkbox("Only frozen", clear_only_frozen)
@@ -257,13 +364,13 @@ class SDFRenderer:
 
             if psim.Button("Clear points"):
                 if len(live_picks) > 0 and not clear_only_frozen:
-                    live_picks = []
+                    live_picks.clear()
                     ps.get_point_cloud("Live Picks").set_transform(np.eye(4))
                     ps.remove_point_cloud("Live Picks")
                     tx, ty, tz, rx, ry, rz = 0.0, 0.0, 0.0, 0.0, 0.0, 0.0
                     # self.shape_color[...] = 0.0
                 if len(frozen_picks) > 0:
-                    frozen_picks = []
+                    frozen_picks.clear()
                     ps.remove_point_cloud("Frozen Picks")
 
         ps.init()
@@ -273,6 +380,7 @@ class SDFRenderer:
             deform_pc.add_vector_quantity("DeformVecs", self.vis_deform[..., 3:], enabled=True)
         ps.set_user_callback(custom_callback)
         ps.show()
+        pick_executor.shutdown(wait=False, cancel_futures=True)
     
         
 
@@ -290,6 +398,9 @@ class SDFRendererConfig(InstantiateConfig):
     max_coord: float =  1.0
     resolution: int = 512
     chunk: int = 65536
+    mesh_cache_size: int = 8
+    precision: Literal['fp32', 'fp16', 'bf16'] = 'fp32'  # 'fp16' is CUDA only
+    compile: bool = False
     window_size: Tuple[int, int] = (1600, 1200)
     device: Literal['cpu', 'cuda'] = 'cuda'
     shape_model: NeuralSDFConfig = NeuralSDFConfig()
@@ -24,11 +24,41 @@ from iarap.model.neural_sdf import NeuralSDF, NeuralSDFConfig
 from iarap.model.arap import ARAPMesh
 from iarap.train.optim import AdamConfig, MultiStepSchedulerConfig
 from iarap.train.trainer import Trainer
-from iarap.utils import delaunay, detach_model
+from iarap.utils import delaunay, detach_model, pointwise_value_and_grad
 from iarap.utils.meshing import get_patch_mesh, sphere_random_uniform, sphere_sunflower, gaussian_max_norm, sphere_gaussian_radius
 
 
 
+def load_point_files(root: Path, names: List[str]) -> np.ndarray:
+    # Selection files are whitespace-separated xyz rows: parse them as flat text and concatenate once
+    return np.concatenate([np.fromfile(root / f"{f}.txt", sep=' ') for f in names]).reshape(-1, 3)
+
+def load_handles(handles_spec: Path, 
+                 device: Literal['cpu', 'cuda'] = 'cpu'
+                 ) -> Tuple[torch.Tensor, torch.Tensor]:
+    handle_cfg = yaml.load(open(handles_spec, 'r'), yaml.Loader)
+    handle_dir = handles_spec.parent
+    assert 'handles' in handle_cfg.keys(), f"Handle specification not found in file {handles_spec}"
+    static = np.empty((0, 3))
+    moving = np.empty((0, 6))
+    if 'static' in handle_cfg['handles'].keys() and len(handle_cfg['handles']['static']['positions']) > 0:
+        static = load_point_files(handle_dir / "parts", handle_cfg['handles']['static']['positions'])
+    if 'moving' in handle_cfg['handles'].keys() and len(handle_cfg['handles']['moving']['positions']) > 0:
+        assert len(handle_cfg['handles']['moving']['positions']) == len(handle_cfg['handles']['moving']['transform']),\
+            "It is required to specify one transform for each handle set"
+        moving_pos = load_point_files(handle_dir / "parts", handle_cfg['handles']['moving']['positions'])
+        moving_trans = load_point_files(handle_dir / "transforms", handle_cfg['handles']['moving']['transform'])
+        assert moving_pos.shape == moving_trans.shape, "Each transform file should match its handle set in size"
+        moving = np.concatenate([moving_pos, moving_trans], axis=-1)
+    # Pack all handle data in a single host buffer and move it to device with one copy
+    n_static = static.size
+    buffer = torch.from_numpy(np.concatenate([static.ravel(), moving.ravel()])).float()
+    if device == 'cuda':
+        buffer = buffer.pin_memory().to(device, non_blocking=True)
+    return buffer[:n_static].view(-1, 3), buffer[n_static:].view(-1, 6)
+
+
+
 class DeformTrainer(Trainer):
 
     def __init__(self, config: DeformTrainerConfig):
@@ -40,37 +70,14 @@ class DeformTrainer(Trainer):
         self.handles = torch.cat([self.handles_moving[:, :3], self.handles_static], dim=0)
         for it in range(self.config.num_projections):
             self.handles = self.source.project_nearest(self.handles).detach()
+        # Delaunay triangulation runs on host through scipy: build a bank of patches once instead of every step
+        self.patch_bank = [self.make_patch_mesh() for _ in range(self.config.num_cached_patches)]
 
     def setup_data(self):
         # Avoids rewriting training function, does a single iteration per epoch
         self.loader = [0]  
         # Configure handles
-        handle_cfg = yaml.load(open(self.config.handles_spec, 'r'), yaml.Loader)
-        handle_dir = self.config.handles_spec.parent
-        assert 'handles' in handle_cfg.keys(), f"Handle specification not found in file {self.config.handles_spec}"
-        if 'static' in handle_cfg['handles'].keys() and len(handle_cfg['handles']['static']['positions']) > 0:
-            static = [np.loadtxt(handle_dir / "parts" / f"{f}.txt").reshape(-1, 3) for f in handle_cfg['handles']['static']['positions']]
-            static = np.concatenate(static, axis=0)
-            if len(static.shape) < 2:
-                static = np.expand_dims(static, 0)
-            self.handles_static = torch.from_numpy(static).to(self.config.device, torch.float)
-        else:
-            self.handles_static = torch.empty((0, 3), device=self.config.device, dtype=torch.float)
-        if 'moving' in handle_cfg['handles'].keys() and len(handle_cfg['handles']['moving']['positions']) > 0:
-            assert len(handle_cfg['handles']['moving']['positions']) == len(handle_cfg['handles']['moving']['transform']),\
-                "It is required to specify one transform for each handle set"
-            moving = [np.loadtxt(handle_dir / "parts" / f"{f}.txt").reshape(-1, 3) for f in handle_cfg['handles']['moving']['positions']]
-            transforms = [np.loadtxt(handle_dir / "transforms" / f"{f}.txt").reshape(-1, 3) for f in handle_cfg['handles']['moving']['transform']]
-            moving = np.concatenate(moving, axis=0)
-            transforms = np.concatenate(transforms, axis=0)
-            if len(moving.shape) < 2:
-                moving = np.expand_dims(moving, axis=0)
-                transforms = np.expand_dims(transforms, axis=0)
-            moving_pos = torch.from_numpy(moving).to(self.config.device, torch.float)
-            moving_trans = torch.from_numpy(transforms).to(self.config.device, torch.float)
-            self.handles_moving = torch.cat([moving_pos, moving_trans], dim=-1)
-        else:
-            self.handles_moving = torch.empty((0, 6), device=self.config.device, dtype=torch.float)
+        self.handles_static, self.handles_moving = load_handles(self.config.handles_spec, self.config.device)
 
     def setup_model(self):
         self.source: NeuralSDF = self.config.shape_model.setup().to(self.config.device).eval()
@@ -79,38 +86,68 @@ class DeformTrainer(Trainer):
         self.model: NeuralRTF = self.config.rotation_model.setup().to(self.config.device).train()
         self.model.set_sdf_callable(self.source.distance)
         self.loss = self.config.loss.setup()
-
-    def sample_domain(self, nsamples):
-        scale = self.config.domain_bounds[1] - self.config.domain_bounds[0]
-        return torch.rand(nsamples, 3, device=self.device) * scale + self.config.domain_bounds[0]
-
-    def local_patch_meshing(self):
+        # Gradient evaluations in project_level_sets cause graph breaks, compile around them
+        self.project_patches = torch.compile(self._project_patches) if self.config.compile_patches else self._project_patches
+        # Per-step sample and patch tensors are written in place into persistent buffers
+        num_samples = self.config.zero_samples + self.config.space_samples
+        self._samples_buf = torch.empty(num_samples, 3, device=self.config.device)
+        self._surf_view = self._samples_buf[:self.config.zero_samples]
+        self._space_view = self._samples_buf[self.config.zero_samples:]
+        self._patch_buf = None
+
+    def make_patch_mesh(self):
+        return get_patch_mesh(sphere_random_uniform, 
+                              delaunay,
+                              self.config.delaunay_sample,
+                              self.config.plane_coords_scale,
+                              self.device)
+
+    def fill_samples(self):
         surf_sample = self.source.sample_zero_level_set(self.config.zero_samples - self.handles.shape[0],
                                                         self.config.near_surface_threshold,
                                                         self.config.attempts_per_step,
                                                         self.config.domain_bounds,
                                                         self.config.num_projections).detach()
-        surf_sample = torch.cat([self.handles, surf_sample], dim=0)
-        space_sample = self.sample_domain(self.config.space_samples)
-        samples = torch.cat([surf_sample, space_sample], dim=0)
+        scale = self.config.domain_bounds[1] - self.config.domain_bounds[0]
+        num_handles = self.handles.shape[0]
+        with torch.no_grad():
+            self._surf_view[:num_handles].copy_(self.handles)
+            self._surf_view[num_handles:].copy_(surf_sample)
+            torch.rand(self._space_view.shape, device=self.device, out=self._space_view)
+            self._space_view.mul_(scale).add_(self.config.domain_bounds[0])
+        return self._samples_buf
+
+    def local_patch_meshing(self):
+        samples = self.fill_samples()
         
-        sdf_outs = self.source(samples, with_grad=True)
-        sample_dist, patch_normals = sdf_outs['dist'], sdf_outs['grad']
+        sample_dist, patch_normals = pointwise_value_and_grad(self.source.distance, samples)
         tangent_planes = self.source.tangent_plane(samples, patch_normals)
 
-        plane_coords, triangles = get_patch_mesh(sphere_random_uniform, 
-                                                 delaunay,
-                                                 self.config.delaunay_sample,
-                                                 self.config.plane_coords_scale,
-                                                 self.device)
+        if len(self.patch_bank) > 0:
+            plane_coords, triangles = self.patch_bank[random.randrange(len(self.patch_bank))]
+        else:
+            plane_coords, triangles = self.make_patch_mesh()
+
+        tangent_pts = self.tangent_points(samples, tangent_planes, plane_coords)
+        level_set_verts = self.project_patches(tangent_pts, sample_dist)
+        return level_set_verts, triangles
 
-        tangent_coords = (tangent_planes.unsqueeze(1) @ plane_coords.view(1, -1, 3, 1)).squeeze() 
-        tangent_pts = tangent_coords + samples.unsqueeze(1) 
+    def _project_patches(self, tangent_pts, sample_dist):
         level_set_verts = tangent_pts
+        level_set_dist = sample_dist.unsqueeze(1)  # n 1 1, broadcasts over patch vertices
         for it in range(self.config.num_projections):
-            level_set_verts = self.source.project_level_sets(level_set_verts, sample_dist)  # n m 3
-        
-        return level_set_verts, triangles
+            level_set_verts = self.source.project_level_sets(level_set_verts, level_set_dist)  # n m 3
+        return level_set_verts
+
+    def tangent_points(self, samples, tangent_planes, plane_coords):
+        patch_shape = (samples.shape[0], plane_coords.shape[0], 3)
+        if self._patch_buf is None or self._patch_buf.shape != patch_shape:
+            self._patch_buf = torch.empty(patch_shape, device=samples.device, dtype=samples.dtype)
+        with torch.no_grad():
+            # (m 3) x (n 3 3)^T -> (n m 3): one batched 3x3 product per patch instead of one per vertex
+            torch.matmul(plane_coords, tangent_planes.transpose(-1, -2), out=self._patch_buf)
+            self._patch_buf.add_(samples.unsqueeze(1))
+        return self._patch_buf
 
     def train_step(self, batch):
 
@@ -159,6 +196,8 @@ class DeformTrainerConfig(InstantiateConfig):
     domain_bounds: Tuple[float, float] = (-1, 1)
     num_projections: int = 5
     plane_coords_scale: float = 0.02
+    num_cached_patches: int = 64
+    compile_patches: bool = False
     device: Literal['cpu', 'cuda'] = 'cuda'
     seed: int = 123456
 
@@ -186,32 +225,7 @@ class MCDeformTrainer(Trainer):
         # Avoids rewriting training function, does a single iteration per epoch
         self.loader = [0]  
         # Configure handles
-        handle_cfg = yaml.load(open(self.config.handles_spec, 'r'), yaml.Loader)
-        handle_dir = self.config.handles_spec.parent
-        assert 'handles' in handle_cfg.keys(), f"Handle specification not found in file {self.config.handles_spec}"
-        if 'static' in handle_cfg['handles'].keys() and len(handle_cfg['handles']['static']['positions']) > 0:
-            static = [np.loadtxt(handle_dir / "parts" / f"{f}.txt") for f in handle_cfg['handles']['static']['positions']]
-            static = np.concatenate(static, axis=0)
-            if len(static.shape) < 2:
-                static = np.expand_dims(static, 0)
-            self.handles_static = torch.from_numpy(static).to(self.config.device, torch.float)
-        else:
-            self.handles_static = torch.empty((0, 3), device=self.config.device, dtype=torch.float)
-        if 'moving' in handle_cfg['handles'].keys() and len(handle_cfg['handles']['moving']['positions']) > 0:
-            assert len(handle_cfg['handles']['moving']['positions']) == len(handle_cfg['handles']['moving']['transform']),\
-                "It is required to specify one transform for each handle set"
-            moving = [np.loadtxt(handle_dir / "parts" / f"{f}.txt") for f in handle_cfg['handles']['moving']['positions']]
-            transforms = [np.loadtxt(handle_dir / "transforms" / f"{f}.txt") for f in  handle_cfg['handles']['moving']['transform']]
-            moving = np.concatenate(moving, axis=0)
-            transforms = np.concatenate(transforms, axis=0)
-            if len(moving.shape) < 2:
-                moving = np.expand_dims(moving, axis=0)
-                transforms = np.expand_dims(transforms, axis=0)
-            moving_pos = torch.from_numpy(moving).to(self.config.device, torch.float)
-            moving_trans = torch.from_numpy(transforms).to(self.config.device, torch.float)
-            self.handles_moving = torch.cat([moving_pos, moving_trans], dim=-1)
-        else:
-            self.handles_moving = torch.empty((0, 6), device=self.config.device, dtype=torch.float)
+        self.handles_static, self.handles_moving = load_handles(self.config.handles_spec, self.config.device)
 
     def setup_model(self):
         self.source: NeuralSDF = self.config.shape_model.setup().to(self.config.device).eval()
@@ -223,10 +237,11 @@ class MCDeformTrainer(Trainer):
                                 self.config.mc_resolution,
                                 device=self.config.device)
             xx, yy, zz = torch.meshgrid(steps, steps, steps, indexing="ij")
-            volume_pts = torch.vstack([xx.ravel(), yy.ravel(), zz.ravel()]).T.float()   
+            # Stacking on the last dim keeps the points contiguous, so every split chunk is a contiguous view
+            volume_pts = torch.stack([xx, yy, zz], dim=-1).reshape(-1, 3)
             f_eval = []
             for sample in tqdm(torch.split(volume_pts, self.config.chunk, dim=0)):
-                f_eval.append(self.source(sample.contiguous())['dist'].cpu())
+                f_eval.append(self.source(sample)['dist'].cpu())
             self.volume_sdf = torch.cat(f_eval, dim=0).reshape(*([self.config.mc_resolution] * 3)).numpy()
 
         self.model: NeuralRTF = self.config.rotation_model.setup().to(self.config.device).train()
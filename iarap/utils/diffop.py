@@ -13,6 +13,13 @@ def gradient(y, x, d_output=None):
         only_inputs=True,
     )[0]
 
+def pointwise_value_and_grad(f, x):
+    # f maps (n, d) -> (n, 1) independently per point: vmap a per-point grad instead of building an autograd tape on x
+    def point_value(p):
+        return f(p.unsqueeze(0)).squeeze()
+    grad, value = torch.func.vmap(torch.func.grad_and_value(point_value))(x.reshape(-1, x.shape[-1]))
+    return value.view(*x.shape[:-1], 1), grad.view(x.shape)
+
 def jacobian(y, x):
     d_output = torch.ones_like(x[..., 0:1], requires_grad=False, device=x.device)
     with torch.set_grad_enabled(True):
@@ -68,10 +68,13 @@ def euler_to_rotation(euler: Float[Tensor, "*batch 3"]) -> Float[Tensor, "*batch
 		cx*cz*sy - sx*cy*sz, cx*cy*sz + sx*cz*sy
 	], dim=-1)
 
-	norm_quat = quaternion / quaternion.norm(p=2, dim=-1, keepdim=True)
+	return quaternion_to_rotation(quaternion)
+
+def quaternion_to_rotation(quat: Float[Tensor, "*batch 4"]) -> Float[Tensor, "*batch 3 3"]:
+	norm_quat = quat / quat.norm(p=2, dim=-1, keepdim=True)
 	w, x, y, z = torch.split(norm_quat, 1, dim=-1)
 
-	B = quaternion.shape[:-1]
+	B = quat.shape[:-1]
 
 	w2, x2, y2, z2 = w.pow(2), x.pow(2), y.pow(2), z.pow(2)
 	wx, wy, wz = w * x, w * y, w * z
@@ -84,6 +87,67 @@ def euler_to_rotation(euler: Float[Tensor, "*batch 3"]) -> Float[Tensor, "*batch
 	], dim=-1).view(*B, 3, 3)
 	return rot_mat
 
+@torch.jit.script
+def _apply_quaternion_components(w: Tensor, qx: Tensor, qy: Tensor, qz: Tensor, 
+								 transl: Tensor, x: Tensor, transpose: bool) -> Tensor:
+	# Rotation entries are quadratic in the quaternion, so normalize by its squared norm once
+	inv_n2 = 1.0 / (w*w + qx*qx + qy*qy + qz*qz)
+	w2, x2, y2, z2 = w*w*inv_n2, qx*qx*inv_n2, qy*qy*inv_n2, qz*qz*inv_n2
+	wx, wy, wz = 2*w*qx*inv_n2, 2*w*qy*inv_n2, 2*w*qz*inv_n2
+	xy, xz, yz = 2*qx*qy*inv_n2, 2*qx*qz*inv_n2, 2*qy*qz*inv_n2
+
+	r00, r01, r02 = w2 + x2 - y2 - z2, xy - wz, wy + xz
+	r10, r11, r12 = wz + xy, w2 - x2 + y2 - z2, yz - wx
+	r20, r21, r22 = xz - wy, wx + yz, w2 - x2 - y2 + z2
+
+	if transpose:
+		v = x - transl
+		v0, v1, v2 = v[..., 0], v[..., 1], v[..., 2]
+		return torch.stack([
+			r00*v0 + r10*v1 + r20*v2,
+			r01*v0 + r11*v1 + r21*v2,
+			r02*v0 + r12*v1 + r22*v2
+		], dim=-1)
+	p0, p1, p2 = x[..., 0], x[..., 1], x[..., 2]
+	return torch.stack([
+		r00*p0 + r01*p1 + r02*p2,
+		r10*p0 + r11*p1 + r12*p2,
+		r20*p0 + r21*p1 + r22*p2
+	], dim=-1) + transl
+
+@torch.jit.script
+def apply_euler_rt(euler: Tensor, transl: Tensor, x: Tensor, transpose: bool = False) -> Tensor:
+	"""Computes R @ x + t (or R^T @ (x - t) if transpose) with R = euler_to_rotation(euler).
+	The rotation is composed entrywise, so no (*batch, 3, 3) tensor is ever materialized.
+	"""
+	half = euler * 0.5
+	c, s = torch.cos(half), torch.sin(half)
+	cx, cy, cz = c[..., 0], c[..., 1], c[..., 2]
+	sx, sy, sz = s[..., 0], s[..., 1], s[..., 2]
+
+	w = cx*cy*cz - sx*sy*sz
+	qx = cx*sy*sz + cy*cz*sx
+	qy = cx*cz*sy - sx*cy*sz
+	qz = cx*cy*sz + sx*cz*sy
+	return _apply_quaternion_components(w, qx, qy, qz, transl, x, transpose)
+
+@torch.jit.script
+def apply_quaternion_rt(quat: Tensor, transl: Tensor, x: Tensor, transpose: bool = False) -> Tensor:
+	"""Computes R @ x + t (or R^T @ (x - t) if transpose) with R = quaternion_to_rotation(quat).
+	Same as apply_euler_rt, but straight-line arithmetic with no trigonometric functions.
+	"""
+	return _apply_quaternion_components(quat[..., 0], quat[..., 1], quat[..., 2], quat[..., 3], 
+										transl, x, transpose)
+
+@torch.jit.script
+def batch_matvec(A: Tensor, x: Tensor, transpose: bool = False) -> Tensor:
+	"""Computes A @ x (or A^T @ x if transpose) for batches of small square matrices.
+	Broadcast multiply-and-sum instead of a batched GEMM, which tiles poorly when M=N=3.
+	"""
+	if transpose:
+		return (A * x.unsqueeze(-1)).sum(-2)
+	return (A * x.unsqueeze(-2)).sum(-1)
+
 def align_vectors(a, b):
 	a, b = F.normalize(a, dim=-1), F.normalize(b, dim=-1)
 	I = torch.diag_embed(torch.ones_like(a))
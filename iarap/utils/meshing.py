@@ -2,7 +2,7 @@ import torch
 import math
 import numpy as np
 
-from typing import Literal, Callable, Tuple
+from typing import Literal, Callable, Iterator, Tuple
 from jaxtyping import Float, Int
 from torch import Tensor
 from scipy.spatial import Delaunay
@@ -56,6 +56,18 @@ def gaussian_max_norm(n: int,
     return torch.cat([torch.zeros((1, 2), device=device), vert], dim=0)
 
 
+def grid_slices(resolution: int,
+                bounds: Tuple[float, float] = (-1, 1),
+                device: Literal['cpu', 'cuda'] = 'cpu') -> Iterator[Float[Tensor, "n 3"]]:
+    """Yields the points of a regular 3D grid one slice at a time, along the first axis.
+    Concatenating the slices gives the same ordering as a raveled meshgrid with 'ij' indexing.
+    """
+    steps = torch.linspace(bounds[0], bounds[1], resolution, device=device)
+    yy, zz = torch.meshgrid(steps, steps, indexing="ij")
+    for x in steps:
+        yield torch.stack(torch.broadcast_tensors(x, yy, zz), dim=-1).view(-1, 3)
+
+
 def get_patch_mesh(point_generator: Callable,
                    point_triangulator: Callable,
                    num_points: int,
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import torch.nn.utils.parametrize as parametrize
 import numpy as np
 
 from typing import Dict, Any, List
@@ -26,6 +27,18 @@ def detach_model(m: nn.Module):
     for p in m.parameters():
         p.requires_grad = False
 
+def fuse_parametrizations(m: nn.Module):
+    """Replaces parametrized tensors (e.g. weight norm) with their current value as plain parameters.
+    Only meant for frozen models, it saves recomputing the parametrization at every forward.
+
+    Args:
+        m: module whose parametrizations are removed in place
+    """
+    for module in m.modules():
+        if parametrize.is_parametrized(module):
+            for name in list(module.parametrizations.keys()):
+                parametrize.remove_parametrizations(module, name, leave_parametrized=True)
+
 def gather_nd_torch(params, indices, batch_dim=1):
     batch_dims = params.size()[:batch_dim]  # [b1, ..., bn]
     batch_size = np.cumprod(list(batch_dims))[-1]  # b1 * ... * bn